@@ -0,0 +1,36 @@
+"""
+Align the event log of a session with the trigger channel exported from the MEG/OPM acquisition,
+and write the acquisition time of each event to the log.
+"""
+
+from pathlib import Path
+import argparse
+
+from utils.alignment import align_log_file
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Align a session log with an exported trigger channel")
+    parser.add_argument("log", type=Path, help="session log")
+    parser.add_argument("triggers", type=Path, help="trigger channel exported from the acquisition (.npy or raw binary)")
+    parser.add_argument("--sfreq", type=float, required=True, help="sampling frequency of the acquisition")
+    parser.add_argument("--dtype", default="int16", help="data type of a raw binary trigger file")
+    parser.add_argument("--n-channels", type=int, default=1, help="number of interleaved channels in a raw binary file")
+    parser.add_argument("--channel", type=int, default=0, help="index of the trigger channel")
+    parser.add_argument("--first-sample", type=int, default=0, help="acquisition sample the exported channel starts at")
+    parser.add_argument("--tolerance", type=float, default=0.01, help="maximum distance (s) between a logged event and its trigger")
+    parser.add_argument("--out", type=Path, default=None, help="where to write the aligned log (default: overwrite the log)")
+    args = parser.parse_args()
+
+    model = align_log_file(
+        args.log, args.triggers, args.sfreq, 
+        out_path=args.out, 
+        tolerance=args.tolerance,
+        first_sample=args.first_sample,
+        dtype=args.dtype, 
+        n_channels=args.n_channels, 
+        channel=args.channel
+    )
+
+    print(f"Offset: {round(model['offset'], 6)} s, Drift: {model['drift']:.9f}")
+    print(f"Matched {model['n_matched']} of {model['n_events']} events, jitter: {round(model['jitter'] * 1000, 3)} ms")
@@ -5,10 +5,8 @@ NOTES: do we want to record button presses outside of the target window? Sanity
 
 from pathlib import Path
 from utils.experiment import Experiment
-import time
 from typing import Union
-import numpy as np
-from utils.SGC_connector import SGC_connector
+from utils.paradigm import compile_cached, load_spec, make_connectors, write_session_record
 
 
 
@@ -28,6 +26,13 @@ class Experiment_A(Experiment):
             QUEST_plus: bool = True,
             ISI_adjustment_factor: float = 0.1,
             logfile: Path = Path("data.csv"),
+            seed: Union[int, None] = None,
+            schedule: Union[dict, None] = None,
+            staircase: Union[dict, None] = None,
+            break_duration: Union[float, bool] = False,
+            QUEST_prior: Union[Path, str, list, None] = None,
+            QUEST_reset_shrinkage: float = 1.0,
+            QUEST_posterior_dir: Union[Path, str, None] = None,
             SGC_connector = None
             ):
         
@@ -46,7 +51,14 @@ class Experiment_A(Experiment):
             reset_QUEST = reset_QUEST,
             QUEST_plus = QUEST_plus,
             ISI_adjustment_factor = ISI_adjustment_factor,
-            logfile = logfile)
+            logfile = logfile,
+            seed = seed,
+            schedule = schedule,
+            staircase = staircase,
+            break_duration = break_duration,
+            QUEST_prior = QUEST_prior,
+            QUEST_reset_shrinkage = QUEST_reset_shrinkage,
+            QUEST_posterior_dir = QUEST_posterior_dir)
         
         self.SGC_connector = SGC_connector
 
@@ -61,45 +73,41 @@ class Experiment_A(Experiment):
 
         if next_event_type == "target/weak":
                 self.SGC_connector.change_intensity(self.intensities["weak"])
+
+    def prepare_for_block(self, events):
+        if self.SGC_connector:
+            self.SGC_connector.change_intensity(self.intensities["salient"])
+            self.SGC_connector.precompute_transitions(self.intensity_transitions())
     
 if __name__ == "__main__":
+    import argparse
+    import secrets
 
-    stim_bit = 1
-    target_bit = 2
-    weak_bit = 4
-    omis_bit = 8
-    response_bit = 16
-    correct = 32
-    incorrect = 64
-
-    trigger_mapping= {
-        "stim/salient": stim_bit,
-        "target/weak": target_bit + weak_bit,  
-        "target/omis": target_bit + omis_bit,
-        "response/omis/correct": response_bit + omis_bit + correct,
-        "response/omis/incorrect": response_bit + weak_bit + incorrect, 
-        "response/weak/correct": response_bit + weak_bit + correct,
-        "response/weak/incorrect": response_bit + omis_bit + incorrect, 
-        }
+    parser = argparse.ArgumentParser(description="Run version A of the experiment from a paradigm spec")
+    parser.add_argument("--spec", type=Path, default=Path("paradigms/experiment_A.toml"))
+    parser.add_argument("--seed", type=int, default=None, help="seed for the event schedule (random if not given)")
+    parser.add_argument("--logfile", type=Path, default=None)
+    args = parser.parse_args()
 
+    seed = args.seed if args.seed is not None else secrets.randbits(32)
+    print(f"Using seed {seed}")
 
-    # connect to the stimulus current generator
-    connector = SGC_connector(
-        port = "/dev/tty.usbserial-A50027Ed",
-        intensity_codes_path=Path("intensity_code.csv"),
-        start_intensity=1
-    )
+    # compile the paradigm (or load it from the cache if the spec and seed are unchanged)
+    paradigm = compile_cached(args.spec, seed=seed)
+    logfile = args.logfile or Path(load_spec(args.spec)["logfile"])
 
-    connector.set_pulse_duration(200)
-    #connector.set_trigger_delay(0)
+    # record the seed and hash next to the log, so the session can be reproduced
+    write_session_record(logfile, args.spec, paradigm)
 
+    # connect to the stimulus current generator
+    connector, = make_connectors(paradigm).values()
 
     experiment = Experiment_A(
-        n_sequences=5,
-        reset_QUEST=3, # reset QUEST every x blocks
-        mean_ISI=1.,
-        trigger_mapping=trigger_mapping,
-        logfile = Path("output_a/test_SGC.csv"),
+        **paradigm["experiment_kwargs"],
+        trigger_mapping=paradigm["trigger_mapping"],
+        schedule=paradigm["schedule"],
+        staircase=paradigm["staircase"],
+        logfile = logfile,
         SGC_connector=connector
     )
     
@@ -2,12 +2,15 @@
 VERSION B - discriminating weak index and ring finger targets following three salient rhythm-establishing stimuli presented to both fingers
 """
 
+from contextlib import contextmanager
 from pathlib import Path
 from typing import Union
 
 # local imports
 from utils.experiment import Experiment
-from utils.SGC_connector import SGCConnector, SGCFakeConnector
+from utils.dispatch import PulseDispatcher
+from utils.posteriors import threshold_posterior
+from utils.paradigm import compile_cached, load_spec, make_connectors, write_session_record
 
 class Experiment_B(Experiment):
     def __init__(
@@ -25,8 +28,30 @@ class Experiment_B(Experiment):
             QUEST_plus: bool = True,
             ISI_adjustment_factor: float = 0.1,
             logfile: Path = Path("data.csv"),
+            seed: Union[int, None] = None,
+            schedule: Union[dict, None] = None,
+            staircase: Union[dict, None] = None,
+            break_duration: Union[float, bool] = False,
+            QUEST_prior: Union[Path, str, list, dict, None] = None,
+            QUEST_reset_shrinkage: float = 1.0,
+            QUEST_posterior_dir: Union[Path, str, None] = None,
+            concurrent_dispatch: bool = False,
+            per_site_QUEST: bool = False,
             SGC_connectors = None
             ):
+        """
+        concurrent_dispatch : bool
+            Send the pulses to all connectors concurrently from per-connector writer threads during `run`, and log
+            the skew between the connectors to <logfile stem>_skew.csv next to the logfile.
+        per_site_QUEST : bool
+            Run a separate QUEST procedure (and weak intensity) for each site.
+        QUEST_prior : Path, str, list, dict or None
+            As for `Experiment`. With per_site_QUEST this can also be a dict with the saved posterior(s) of each site,
+            e.g. {"left": "<stem>_session_left.npy", "right": "<stem>_session_right.npy"}, so each site warm starts
+            from its own posterior. Sites left out start from a flat prior.
+        """
+        # needed by QUEST_reset, which is called when initialising the parent class
+        self.per_site_QUEST = per_site_QUEST
         
         super().__init__(
             trigger_mapping = trigger_mapping,
@@ -43,70 +68,171 @@ class Experiment_B(Experiment):
             reset_QUEST = reset_QUEST,
             QUEST_plus = QUEST_plus,
             ISI_adjustment_factor = ISI_adjustment_factor,
-            logfile = logfile)
+            logfile = logfile,
+            seed = seed,
+            schedule = schedule,
+            staircase = staircase,
+            break_duration = break_duration,
+            QUEST_prior = QUEST_prior,
+            QUEST_reset_shrinkage = QUEST_reset_shrinkage,
+            QUEST_posterior_dir = QUEST_posterior_dir)
             
         self.SGC_connectors = SGC_connectors
+        self.concurrent_dispatch = concurrent_dispatch
+        self.dispatcher = None # only set while dispatching (see `dispatching`)
     
     def deliver_stimulus(self, event_type):
-        if self.SGC_connectors: 
+        if self.dispatcher:
+            # wait for the writer threads, so the onset logged is the time the pulse was actually sent
+            if "salient" in event_type: # send to all fingers at once
+                return self.dispatcher.send_pulse(label=event_type, wait=True).onset
+            elif "target" in event_type:
+                return self.dispatcher.send_pulse([event_type.split("/")[-1]], label=event_type, wait=True).onset
+
+        elif self.SGC_connectors: 
                 if "salient" in event_type: # send to both fingers
                     for connector in self.SGC_connectors.values():
                         connector.send_pulse()
                 elif self.SGC_connectors and "target" in event_type: # send to the finger specified in the event type
                     self.SGC_connectors[event_type.split("/")[-1]].send_pulse()
 
+    def change_intensity(self, site, intensity):
+        if self.dispatcher:
+            self.dispatcher.change_intensity(site, intensity)
+        else:
+            self.SGC_connectors[site].change_intensity(intensity)
+
     def prepare_for_next_stimulus(self, event_type, next_event_type):
         if self.SGC_connectors:
             # after sending the trigger for the weak target stimulation change the intensity to the salient intensity
             if "target" in event_type: 
-                self.SGC_connectors[event_type.split("/")[-1]].change_intensity(self.intensities["salient"])
+                self.change_intensity(event_type.split("/")[-1], self.intensities["salient"])
 
             # check if next stimuli is weak, then lower based on which!
             if "target" in next_event_type:
-                self.SGC_connectors[next_event_type.split("/")[-1]].change_intensity(self.intensities["weak"])
+                self.change_intensity(next_event_type.split("/")[-1], self.weak_intensity(next_event_type))
+
+    def weak_intensity(self, event_type):
+        if self.per_site_QUEST:
+            return self.site_intensities[event_type.split("/")[-1]]
+        return self.intensities["weak"]
+
+    def load_QUEST_prior(self, QUEST_prior):
+        if not isinstance(QUEST_prior, dict):
+            return super().load_QUEST_prior(QUEST_prior)
+
+        sites = [self.target_1, self.target_2]
+        if not self.per_site_QUEST:
+            raise ValueError("A QUEST_prior per site requires per_site_QUEST")
+        unknown = [site for site in QUEST_prior if site not in sites]
+        if unknown:
+            raise ValueError(f"Unknown sites {unknown} in QUEST_prior, should be one of {sites}")
+
+        load = super().load_QUEST_prior
+        return {site: load(QUEST_prior.get(site)) for site in sites}
+
+    def site_prior(self, site=None):
+        if isinstance(self.QUEST_prior, dict):
+            return self.QUEST_prior.get(site)
+        return self.QUEST_prior
+
+    def prepare_QUEST(self, prior=None):
+        if self.per_site_QUEST:
+            prepare = super().prepare_QUEST
+            if isinstance(self.QUEST_prior, dict): # each site starts from its own prior
+                return {site: prepare(self.site_prior(site)) for site in [self.target_1, self.target_2]}
+            return {site: prepare(prior) for site in [self.target_1, self.target_2]}
+        return super().prepare_QUEST(prior)
+
+    def QUEST_reset(self):
+        if not self.per_site_QUEST:
+            return super().QUEST_reset()
+        
+        if self.prepared_QUEST:
+            prepared = self.prepared_QUEST
+        else:
+            # each site continues from its own posterior (if QUEST_reset_shrinkage < 1)
+            site_QUEST = getattr(self, "site_QUEST", {})
+            prepare = super().prepare_QUEST
+            prepared = {site: prepare(self.reset_prior(site_QUEST.get(site), site)) for site in [self.target_1, self.target_2]}
+        self.prepared_QUEST = None
+
+        self.site_QUEST = {site: QUEST for site, (QUEST, _) in prepared.items()}
+        self.site_intensities = {site: intensity for site, (_, intensity) in prepared.items()}
+        print("QUEST has been reset for all sites")
+
+    def QUEST_posteriors(self):
+        if self.per_site_QUEST:
+            return {site: threshold_posterior(QUEST) for site, QUEST in self.site_QUEST.items()}
+        return super().QUEST_posteriors()
+
+    def update_QUEST(self, correct, intensity, event_type):
+        if not self.per_site_QUEST:
+            return super().update_QUEST(correct, intensity, event_type)
+        
+        site = event_type.split("/")[-1]
+        self.site_QUEST[site].addResponse(correct, intensity = intensity)
+        self.site_intensities[site] = round(self.site_QUEST[site].next(), 1)
+
+    def prepare_for_block(self, events):
+        if self.dispatcher:
+            # make sure the writer threads are idle before using the connectors directly
+            self.dispatcher.wait()
+            self.dispatcher.flush()
+
+        if self.SGC_connectors:
+            transitions = self.intensity_transitions()
+            for connector in self.SGC_connectors.values():
+                connector.change_intensity(self.intensities["salient"])
+                connector.precompute_transitions(transitions)
+
+    @contextmanager
+    def dispatching(self):
+        """
+        Send the pulses from the writer threads of a PulseDispatcher within the context (if concurrent_dispatch is set).
+        The threads are stopped and the skews flushed when leaving the context, also if the experiment is interrupted.
+        """
+        if not (self.concurrent_dispatch and self.SGC_connectors):
+            yield
+            return
+
+        logfile = Path(self.logfile)
+        try:
+            with PulseDispatcher(self.SGC_connectors, skew_log=logfile.with_name(f"{logfile.stem}_skew.csv"), clock=self.clock) as self.dispatcher:
+                yield
+        finally:
+            self.dispatcher = None
 
     
 
 if __name__ == "__main__":
+    import argparse
+    import secrets
 
-    stim_bit = 1
-    target_bit = 2
-    right_bit = 4
-    left_bit = 8
-    response_bit = 16
-    correct = 32
-    incorrect = 64
-
-    trigger_mapping= {
-        "stim/salient": stim_bit,
-        "target/right": target_bit + right_bit,  
-        "target/left": target_bit + left_bit,
-        "response/left/correct": response_bit + left_bit + correct,
-        "response/right/incorrect": response_bit + right_bit + incorrect, 
-        "response/right/correct": response_bit + right_bit + correct,
-        "response/left/incorrect": response_bit + left_bit + incorrect, 
-        }
-    
-    start_intensities = {"salient": 4.0, "weak": 1.0} # SALIENT NEEDS TO BE AT LEAST xx BIGGER THAN 
+    parser = argparse.ArgumentParser(description="Run version B of the experiment from a paradigm spec")
+    parser.add_argument("--spec", type=Path, default=Path("paradigms/experiment_B.toml"))
+    parser.add_argument("--seed", type=int, default=None, help="seed for the event schedule (random if not given)")
+    parser.add_argument("--logfile", type=Path, default=None)
+    args = parser.parse_args()
 
+    seed = args.seed if args.seed is not None else secrets.randbits(32)
+    print(f"Using seed {seed}")
 
-    connectors = {
-        "left":  SGCConnector(port="/dev/tty.usbserial-5", intensity_codes_path=Path("intensity_code.csv"), start_intensity=1),
-        "right": SGCFakeConnector(intensity_codes_path=Path("intensity_code.csv"), start_intensity=1)
-    }
+    # compile the paradigm (or load it from the cache if the spec and seed are unchanged)
+    paradigm = compile_cached(args.spec, seed=seed)
+    logfile = args.logfile or Path(load_spec(args.spec)["logfile"])
 
-    for side, connector in connectors.items():
-        connector.set_pulse_duration(200)
-        connector.change_intensity(start_intensities["salient"])
-    
+    # record the seed and hash next to the log, so the session can be reproduced
+    write_session_record(logfile, args.spec, paradigm)
+
+    connectors = make_connectors(paradigm)
 
     experiment = Experiment_B(
-        intensities=start_intensities,
-        n_sequences=5,
-        reset_QUEST=3, # reset QUEST every x blocks
-        mean_ISI=1.39,
-        trigger_mapping=trigger_mapping,
-        logfile = Path("output_b/test_SGC.csv"),
+        **paradigm["experiment_kwargs"],
+        trigger_mapping=paradigm["trigger_mapping"],
+        schedule=paradigm["schedule"],
+        staircase=paradigm["staircase"],
+        logfile = logfile,
         SGC_connectors=connectors
     )
     
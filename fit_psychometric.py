@@ -0,0 +1,27 @@
+"""
+Refit the psychometric functions of all sessions, separately for each ISI condition (A, B and C)
+and target site, with bootstrap confidence intervals.
+"""
+
+from pathlib import Path
+import argparse
+import os
+
+from utils.psychometric import fit_psychometric, read_all_trials
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit psychometric functions to all session logs")
+    parser.add_argument("logs", type=Path, nargs="+", help="session logs")
+    parser.add_argument("--n-boot", type=int, default=1000, help="number of bootstrap samples (0 to skip the confidence intervals)")
+    parser.add_argument("--target", type=float, default=0.75, help="proportion correct to report the intensity for")
+    parser.add_argument("--n-jobs", type=int, default=os.cpu_count(), help="number of processes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=Path, default=Path("psychometric_fits.csv"))
+    args = parser.parse_args()
+
+    trials = read_all_trials(args.logs, n_jobs=args.n_jobs)
+    fits = fit_psychometric(trials, n_boot=args.n_boot, target=args.target, n_jobs=args.n_jobs, seed=args.seed)
+
+    fits.to_csv(args.out, index=False)
+    print(fits.to_string(index=False))
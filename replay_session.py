@@ -0,0 +1,31 @@
+"""
+Replay a logged session with simulated connectors and scripted responses, and compare the timing and
+QUEST trajectory to the original log.
+"""
+
+from pathlib import Path
+import argparse
+
+from utils.paradigm import compile_spec, load_spec
+from utils.replay import replay_session, summarise_diff
+from utils.simulation import make_simulated_experiment
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a logged session and compare it to the original")
+    parser.add_argument("log", type=Path, help="session log to replay")
+    parser.add_argument("--spec", type=Path, required=True, help="paradigm spec used for the session")
+    parser.add_argument("--out", type=Path, default=None, help="log of the replayed session")
+    parser.add_argument("--realtime", action="store_true", help="replay at real-time speed instead of as fast as possible")
+    args = parser.parse_args()
+
+    # the schedule is taken from the log, so the seed does not matter here
+    paradigm = compile_spec(load_spec(args.spec), seed=0)
+    # replay sends from the main thread (the dispatcher is not used outside `dispatching` anyway)
+    experiment = make_simulated_experiment(paradigm, concurrent_dispatch=False)
+
+    out = args.out or args.log.with_name(f"{args.log.stem}_replay.csv")
+    diff = replay_session(experiment, args.log, out, realtime=args.realtime)
+
+    diff.to_csv(out.with_name(f"{out.stem}_diff.csv"), index=False)
+    summarise_diff(diff)
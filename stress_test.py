@@ -0,0 +1,56 @@
+"""
+Stress mode: sweep the ISI downwards and the number of sequences upwards with scripted responses to find
+the smallest ISI at which the onset error stays within the tolerance, separately for version A and B.
+"""
+
+from pathlib import Path
+import argparse
+
+import pandas as pd
+
+from utils.paradigm import compile_spec, load_spec, make_connectors
+from utils.simulation import make_simulated_experiment
+from utils.stress import stress_sweep, throughput_ceiling
+
+
+def experiment_factory(spec_path: Path, real_connectors: bool = False, out_dir: Path = Path("output_stress")):
+    """
+    Returns a function creating a new experiment (and its connectors) from a paradigm spec for each stress run.
+    The dispatch configured in the spec is used, and the skew log (with concurrent dispatch) is written to out_dir.
+    """
+    paradigm = compile_spec(load_spec(spec_path), seed=0)
+
+    def make_experiment():
+        connectors = make_connectors(paradigm) if real_connectors else None
+        experiment = make_simulated_experiment(paradigm, connectors)
+        experiment.logfile = Path(out_dir) / f"{Path(spec_path).stem}_stress.csv"
+        connectors = experiment.SGC_connectors.values() if paradigm["experiment"] == "B" else [experiment.SGC_connector]
+
+        return experiment, list(connectors)
+
+    return make_experiment
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the throughput ceiling of the paradigm")
+    parser.add_argument("--specs", type=Path, nargs="+", default=[Path("paradigms/experiment_A.toml"), Path("paradigms/experiment_B.toml")])
+    parser.add_argument("--ISIs", type=float, nargs="+", default=[1.0, 0.75, 0.5, 0.4, 0.3, 0.2, 0.15, 0.1, 0.075, 0.05])
+    parser.add_argument("--n-sequences", type=int, nargs="+", default=[5, 10, 20])
+    parser.add_argument("--tolerance", type=float, default=0.005, help="maximum allowed onset error in seconds")
+    parser.add_argument("--real", action="store_true", help="use the connectors from the spec instead of simulated ones")
+    parser.add_argument("--out", type=Path, default=Path("output_stress"))
+    args = parser.parse_args()
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    summaries = []
+    for spec in args.specs:
+        results = stress_sweep(experiment_factory(spec, args.real, args.out), args.ISIs, args.n_sequences, tolerance=args.tolerance)
+        results.to_csv(args.out / f"{spec.stem}_sweep.csv", index=False)
+
+        summary = throughput_ceiling(results)
+        summary.insert(0, "paradigm", spec.stem)
+        summaries.append(summary)
+
+    summary = pd.concat(summaries, ignore_index=True)
+    summary.to_csv(args.out / "throughput_ceiling.csv", index=False)
+    print(summary.to_string(index=False))
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from utils.posteriors import load_posterior, normalise, save_posterior, threshold_posterior
+
+data = pytest.importorskip("psychopy.data")
+
+
+def test_save_and_reload_threshold_posterior(tmp_path):
+    grid = [round(intensity, 1) for intensity in np.arange(1.0, 5.5, 0.1)]
+    QUEST = data.QuestPlusHandler(
+        nTrials=None,
+        intensityVals=grid,
+        thresholdVals=grid,
+        slopeVals=2,
+        lowerAsymptoteVals=0.5,
+        lapseRateVals=0.05,
+        responseVals=(1, 0),
+        stimScale="linear",
+    )
+    QUEST.addResponse(1, intensity=QUEST.next())
+
+    posterior = threshold_posterior(QUEST)
+    assert posterior.shape == (len(grid),)
+
+    save_posterior(tmp_path / "session.npy", grid, posterior)
+    reloaded = load_posterior(tmp_path / "session.npy", grid)
+
+    np.testing.assert_allclose(reloaded, normalise(posterior), atol=1e-6)
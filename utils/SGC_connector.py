@@ -10,6 +10,7 @@ class BaseSGCConnector(ABC):
         self.current_intensity = start_intensity
         self.PULSE_COMMAND = "?*A,S$C0#"
         self.WAKEUP_COMMAND = "?*W$57#"
+        self.transitions = {}
 
     def prep_intensity_codes_lookup(self, path):
         lookup = {}
@@ -26,22 +27,40 @@ class BaseSGCConnector(ABC):
     def send_pulse(self):
         self.send_command(self.PULSE_COMMAND)
 
-    def change_intensity(self, target_intensity: float):
-        target_intensity = round(target_intensity, 1)
-
-        if self.current_intensity == target_intensity:
-            return
+    def transition_commands(self, current_intensity: float, target_intensity: float) -> list[str]:
+        """Commands needed to change from the current to the target intensity."""
+        if current_intensity == target_intensity:
+            return []
 
-        elif self.current_intensity > target_intensity:
-            self.send_command(self.command_lookup[target_intensity])
+        elif current_intensity > target_intensity:
+            return [self.command_lookup[target_intensity]]
         else:
-            if target_intensity - self.current_intensity > 1:
-                start = np.ceil(self.current_intensity)
+            commands = []
+            if target_intensity - current_intensity > 1:
+                start = np.ceil(current_intensity)
                 end = np.floor(target_intensity) + 1
                 stepping_stones = np.arange(start, end, 1.0)
                 for stone in stepping_stones:
-                    self.send_command(self.command_lookup[stone])
-            self.send_command(self.command_lookup[target_intensity])
+                    commands.append(self.command_lookup[stone])
+            commands.append(self.command_lookup[target_intensity])
+            return commands
+
+    def precompute_transitions(self, transitions: list[tuple]):
+        """Look up the commands for the given (current, target) intensity pairs in advance."""
+        for current_intensity, target_intensity in transitions:
+            key = (round(current_intensity, 1), round(target_intensity, 1))
+            if key not in self.transitions:
+                self.transitions[key] = self.transition_commands(*key)
+
+    def change_intensity(self, target_intensity: float):
+        target_intensity = round(target_intensity, 1)
+
+        commands = self.transitions.get((self.current_intensity, target_intensity))
+        if commands is None:
+            commands = self.transition_commands(self.current_intensity, target_intensity)
+
+        for command in commands:
+            self.send_command(command)
 
         self.current_intensity = target_intensity
 
@@ -79,10 +98,12 @@ class SGCConnector(BaseSGCConnector):
 
 
 class SGCFakeConnector(BaseSGCConnector):
-    def __init__(self, intensity_codes_path: Path, start_intensity=1):
+    def __init__(self, intensity_codes_path: Path, start_intensity=1, verbose=True):
         super().__init__(intensity_codes_path, start_intensity)
         self.sent_commands : list[str] = []
+        self.verbose = verbose
 
     def send_command(self, command: str):
-        print(f"[FAKE SEND] {command}")  # or just log it
+        if self.verbose:
+            print(f"[FAKE SEND] {command}")  # or just log it
         self.sent_commands.append(command)
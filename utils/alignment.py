@@ -0,0 +1,183 @@
+"""
+Description: Alignment of the perf_counter based event log with the acquisition timeline of the MEG/OPM system.
+The logged trigger sequence is matched against the trigger channel exported from the acquisition, and a linear
+clock model (offset plus drift) is fitted to the matched events.
+"""
+
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from .logs import read_session_log
+
+
+def load_trigger_channel(path: Path, dtype: str = "int16", n_channels: int = 1, channel: int = 0) -> np.ndarray:
+    """
+    Memory-map a trigger channel exported from the acquisition system.
+
+    Parameters
+    ----------
+    path : Path
+        Either a .npy file with a single channel (samples) or several channels (samples x channels),
+        or a raw binary file with n_channels interleaved channels of the given dtype.
+    dtype : str
+        Data type of the raw binary file (ignored for .npy files).
+    n_channels : int
+        Number of interleaved channels in the raw binary file (ignored for .npy files).
+    channel : int
+        Index of the trigger channel (ignored for single channel files).
+    """
+    path = Path(path)
+    if path.suffix == ".npy":
+        data = np.load(path, mmap_mode="r")
+        if data.ndim == 2:
+            return data[:, channel]
+        if data.ndim != 1:
+            raise ValueError(f"Expected a trigger file with one (samples) or two (samples x channels) dimensions, got shape {data.shape}")
+        return data
+
+    data = np.memmap(path, dtype=dtype, mode="r")
+    if n_channels > 1:
+        data = data.reshape(-1, n_channels)[:, channel]
+
+    return data
+
+
+def trigger_onsets(trigger_channel: np.ndarray, sfreq: float, first_sample: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the onsets and codes of all triggers in a trigger channel.
+
+    Returns
+    -------
+    times : np.ndarray
+        Onset times in seconds on the acquisition timeline.
+    codes : np.ndarray
+        The trigger code at each onset.
+    """
+    onsets = np.flatnonzero((trigger_channel[1:] != trigger_channel[:-1]) & (trigger_channel[1:] > 0)) + 1
+    if trigger_channel[0] > 0:
+        onsets = np.concatenate([[0], onsets])
+
+    times = (onsets + first_sample) / sfreq
+    codes = np.asarray(trigger_channel[onsets]).astype(int)
+
+    return times, codes
+
+
+def match_events(log_times, log_codes, acq_times, acq_codes, offset: float, drift: float = 1.0, tolerance: float = 0.01) -> np.ndarray:
+    """
+    Match each logged event to the nearest acquisition trigger with the same code, given a clock model.
+
+    Returns
+    -------
+    np.ndarray
+        Index into acq_times for each logged event, -1 if no trigger with the same code was found within the tolerance.
+    """
+    predicted = offset + drift * np.asarray(log_times)
+
+    # nearest acquisition trigger on either side of the predicted time
+    right = np.clip(np.searchsorted(acq_times, predicted), 0, len(acq_times) - 1)
+    left = np.clip(right - 1, 0, len(acq_times) - 1)
+    nearest = np.where(np.abs(acq_times[left] - predicted) < np.abs(acq_times[right] - predicted), left, right)
+
+    matched = (np.abs(acq_times[nearest] - predicted) < tolerance) & (acq_codes[nearest] == np.asarray(log_codes))
+
+    return np.where(matched, nearest, -1)
+
+
+def initial_offset(log_times, log_codes, acq_times, acq_codes, tolerance: float = 0.01, n_anchors: int = 5) -> float:
+    """
+    Find the offset between the clocks by trying every acquisition trigger with the same code as one of the
+    first n_anchors logged events whose code occurs in the trigger channel as anchor, and keeping the one that
+    matches the most events. Logged events with codes that are never sent to the channel (e.g. stimuli without
+    a trigger) cannot be anchors.
+    """
+    log_times = np.asarray(log_times)
+    log_codes = np.asarray(log_codes)
+
+    anchors = np.flatnonzero(np.isin(log_codes, acq_codes))[:n_anchors]
+    if len(anchors) == 0:
+        raise ValueError("None of the logged triggers are present in the trigger channel")
+
+    candidates = np.concatenate([acq_times[acq_codes == log_codes[i]] - log_times[i] for i in anchors])
+
+    # score all candidate offsets at once (candidates x events in the trigger channel)
+    predicted = candidates[:, None] + log_times[np.isin(log_codes, acq_codes)][None, :]
+    idx = np.clip(np.searchsorted(acq_times, predicted), 1, len(acq_times) - 1)
+    distance = np.minimum(np.abs(acq_times[idx] - predicted), np.abs(acq_times[idx - 1] - predicted))
+    n_matched = (distance < tolerance).sum(axis=1)
+
+    return float(candidates[np.argmax(n_matched)])
+
+
+def fit_clock(log_times, acq_times) -> tuple[float, float]:
+    """
+    Least squares fit of acq_time = offset + drift * log_time.
+
+    Returns
+    -------
+    offset, drift
+    """
+    drift, offset = np.polyfit(np.asarray(log_times, dtype=float), np.asarray(acq_times, dtype=float), deg=1)
+
+    return float(offset), float(drift)
+
+
+def align_log(df: pd.DataFrame, acq_times: np.ndarray, acq_codes: np.ndarray, tolerance: float = 0.01, n_iterations: int = 3) -> tuple[pd.DataFrame, dict]:
+    """
+    Align a session log to the acquisition timeline.
+
+    Adds the columns "acq_time" (the log time converted with the fitted clock model), "acq_trigger_time"
+    (the time of the matched acquisition trigger, NaN if unmatched) and "acq_residual" (trigger time minus model time).
+
+    Returns
+    -------
+    df : pd.DataFrame
+        The log with the added columns.
+    model : dict
+        The fitted offset and drift, the number of matched events and the residual jitter (standard deviation).
+    """
+    df = df.copy()
+    log_times = df["time"].to_numpy(dtype=float)
+    log_codes = df["trigger"].to_numpy(dtype=int)
+
+    offset, drift = initial_offset(log_times, log_codes, acq_times, acq_codes, tolerance), 1.0
+    for _ in range(n_iterations):
+        matches = match_events(log_times, log_codes, acq_times, acq_codes, offset, drift, tolerance)
+        matched = matches >= 0
+        if matched.sum() < 2:
+            raise ValueError("Too few logged triggers could be matched to fit the clock model")
+        offset, drift = fit_clock(log_times[matched], acq_times[matches[matched]])
+
+    # match once more, so the matched triggers are those of the final clock model
+    matches = match_events(log_times, log_codes, acq_times, acq_codes, offset, drift, tolerance)
+    matched = matches >= 0
+
+    df["acq_time"] = offset + drift * log_times
+    df["acq_trigger_time"] = np.where(matched, acq_times[matches], np.nan)
+    df["acq_residual"] = df["acq_trigger_time"] - df["acq_time"]
+
+    model = {
+        "offset": offset,
+        "drift": drift,
+        "n_matched": int(matched.sum()),
+        "n_events": len(df),
+        "jitter": float(np.nanstd(df["acq_residual"])),
+    }
+
+    return df, model
+
+
+def align_log_file(log_path: Path, trigger_path: Path, sfreq: float, out_path: Union[Path, None] = None, tolerance: float = 0.01, first_sample: int = 0, **channel_kwargs) -> dict:
+    """
+    Align a session log file to an exported trigger channel and write the log with the acquisition time columns.
+    If no out_path is given, the columns are written back to the log itself. first_sample is the acquisition sample
+    the exported channel starts at, so the acquisition times match those of the recording.
+    """
+    acq_times, acq_codes = trigger_onsets(load_trigger_channel(trigger_path, **channel_kwargs), sfreq, first_sample)
+    df, model = align_log(read_session_log(log_path), acq_times, acq_codes, tolerance)
+    df.to_csv(out_path or log_path, index=False)
+
+    return model
@@ -0,0 +1,201 @@
+"""
+Description: Concurrent dispatch of pulses to N stimulators. Each connector has its own writer thread, and the
+threads sending the same pulse are released together by a barrier. The skew between devices is logged per pulse.
+Errors in the writer threads are re-raised on the main thread at the next send_pulse, wait or close.
+"""
+
+from pathlib import Path
+import queue
+import threading
+import time
+from typing import Callable, Union
+
+
+class Pulse:
+    """A pulse sent to one or more sites at the same time."""
+
+    def __init__(self, pulse_id: int, sites: list, label: str, on_done, submit_time: float, timeout: float):
+        self.pulse_id = pulse_id
+        self.sites = sites
+        self.label = label
+        self.on_done = on_done
+        self.submit_time = submit_time
+        self.release = threading.Barrier(len(sites), timeout=timeout)
+        self.send_times = {}
+        self.failed_sites = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    @property
+    def onset(self) -> float:
+        """Time the first site was sent the pulse."""
+        return min(self.send_times.values())
+
+    def sent(self, site, send_time):
+        with self.lock:
+            self.send_times[site] = send_time
+            done = len(self.send_times) + len(self.failed_sites) == len(self.sites)
+
+        if done:
+            if not self.failed_sites:
+                self.on_done(self)
+            self.done.set()
+
+    def failed(self, site):
+        """The pulse could not be sent to a site. The other sites are no longer waited for."""
+        with self.lock:
+            self.failed_sites.append(site)
+            done = len(self.send_times) + len(self.failed_sites) == len(self.sites)
+        self.release.abort()
+
+        if done:
+            self.done.set()
+
+
+class PulseDispatcher:
+    def __init__(self, connectors: dict, skew_log: Union[Path, None] = None, clock: Callable = time.perf_counter, release_timeout: float = 1.0):
+        """
+        Parameters
+        ----------
+        connectors : dict
+            The SGC connectors, keyed by site.
+        skew_log : Path or None
+            CSV file the skew of each pulse is appended to when flushing. If None, the skews are only kept in memory.
+        clock : callable
+            Clock used for the submit and send times (should be the clock of the experiment, so the onsets can be logged).
+        release_timeout : float
+            Maximum time in seconds the writer threads of a pulse wait for each other before giving up on it.
+        """
+        self.connectors = connectors
+        self.skew_log = skew_log
+        self.clock = clock
+        self.release_timeout = release_timeout
+        self.error = None # first error raised in a writer thread, re-raised on the main thread
+        self.skews = []
+        self.pulse_counter = 0
+        self.lock = threading.Lock()
+
+        self.queues = {site: queue.Queue() for site in connectors}
+        self.threads = [threading.Thread(target=self.writer, args=(site,), daemon=True) for site in connectors]
+        for thread in self.threads:
+            thread.start()
+
+        if self.skew_log:
+            Path(self.skew_log).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.skew_log, "w") as f:
+                f.write("pulse,label,sites,latency,skew\n")
+
+    def writer(self, site):
+        """Writer thread for one connector, handling its commands in the order they were submitted."""
+        connector = self.connectors[site]
+        commands = self.queues[site]
+
+        while True:
+            command = commands.get()
+            if command is None:
+                commands.task_done()
+                break
+
+            kind, value = command
+            try:
+                if kind == "intensity":
+                    connector.change_intensity(value)
+                elif kind == "pulse":
+                    value.release.wait() # wait for the other sites of the pulse
+                    connector.send_pulse()
+                    value.sent(site, self.clock())
+
+            except threading.BrokenBarrierError:
+                # another site of the pulse failed (its error is recorded) or did not get to the pulse in time
+                if not value.failed_sites:
+                    self.record_error(TimeoutError(f"Pulse {value.pulse_id} ({value.label}) was not released within {self.release_timeout} s"))
+                value.failed(site)
+
+            except Exception as error:
+                # keep the thread alive so the queue is still drained, and report the error on the main thread
+                self.record_error(error)
+                if kind == "pulse":
+                    value.failed(site)
+
+            finally:
+                commands.task_done()
+
+    def send_pulse(self, sites: Union[list, None] = None, label: str = "", wait: bool = False) -> Pulse:
+        """
+        Send a pulse to the given sites (all sites if None).
+
+        If wait is True, block until all sites have been sent the pulse. Waiting releases the GIL, so the writer
+        threads run straight away instead of at the next switch interval of a busy main thread.
+        """
+        self.raise_error()
+
+        sites = list(self.connectors) if sites is None else sites
+        self.pulse_counter += 1
+        pulse = Pulse(self.pulse_counter, sites, label, self.record_skew, self.clock(), self.release_timeout)
+
+        for site in sites:
+            self.queues[site].put(("pulse", pulse))
+
+        if wait:
+            pulse.done.wait()
+            self.raise_error()
+
+        return pulse
+
+    def change_intensity(self, site, intensity: float):
+        """Change the intensity of a site after the commands already submitted to it."""
+        self.queues[site].put(("intensity", intensity))
+
+    def record_skew(self, pulse: Pulse):
+        send_times = pulse.send_times.values()
+        with self.lock:
+            self.skews.append((pulse.pulse_id, pulse.label, "+".join(pulse.sites), min(send_times) - pulse.submit_time, max(send_times) - min(send_times)))
+
+    def record_error(self, error: Exception):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+
+    def raise_error(self):
+        """Re-raise the first error of the writer threads (once)."""
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def wait(self):
+        """Wait until all submitted commands have been handled."""
+        for commands in self.queues.values():
+            commands.join()
+
+        self.raise_error()
+
+    def flush(self):
+        """Write the skews recorded since the last flush to the skew log."""
+        if not self.skew_log:
+            return
+
+        with self.lock:
+            skews, self.skews = self.skews, []
+
+        with open(self.skew_log, "a") as f:
+            for pulse_id, label, sites, latency, skew in skews:
+                f.write(f"{pulse_id},{label},{sites},{latency},{skew}\n")
+
+    def close(self, raise_error: bool = True):
+        """Stop the writer threads after the submitted commands have been handled."""
+        for commands in self.queues.values():
+            commands.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        self.flush()
+        if raise_error:
+            self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # do not replace an exception that is already being raised
+        self.close(raise_error=exc_type is None)
@@ -1,8 +1,10 @@
+from contextlib import contextmanager
 from pathlib import Path
 import numpy as np
-from numpy.random import choice
 from typing import Union
 import time
+import gc
+import os
 
 import sys
 sys.path.append("..")
@@ -10,6 +12,7 @@ sys.path.append("..")
 from psychopy.clock import CountdownTimer
 from psychopy.data import QuestPlusHandler, QuestHandler
 
+from .posteriors import load_prior, save_posterior, shrink, threshold_posterior
 from .responses import KeyboardListener
 from .triggers import setParallelData
 
@@ -32,6 +35,13 @@ class Experiment:
             QUEST_plus: bool = True,
             ISI_adjustment_factor: float = 0.1,
             logfile: Path = Path("data.csv"),
+            seed: Union[int, None] = None,
+            schedule: Union[dict, None] = None,
+            staircase: Union[dict, None] = None,
+            break_duration: Union[float, bool] = False,
+            QUEST_prior: Union[Path, str, list, None] = None,
+            QUEST_reset_shrinkage: float = 1.0,
+            QUEST_posterior_dir: Union[Path, str, None] = None,
             ):
         """
         Initializes the parameters and attributes for the experimental paradigm.
@@ -82,6 +92,35 @@ class Experiment:
         logfile : Path, optional
             Path to the log file for saving experimental data. Defaults to Path("data.csv").
         
+        seed : int or None, optional
+            Seed for drawing the target types. Defaults to None (unseeded).
+
+        schedule : dict or None, optional
+            Precompiled target draws as produced by `utils.paradigm.compile_spec`, with the keys
+            "det_respiratory_rate" (list of target types) and "blocks" (one list of target types per block).
+            If given, the targets are taken from the schedule instead of being drawn. Defaults to None.
+
+        staircase : dict or None, optional
+            Keyword arguments overriding the default QUEST settings (e.g. the intensity and threshold grids).
+            Defaults to None.
+
+        break_duration : float or bool, optional
+            Minimum duration of the break between blocks in seconds. During the break the log is flushed and the
+            next block is prepared, so the break lasts longer if the preparation is not done in time.
+            Set to False to run the blocks back to back. Defaults to False.
+
+        QUEST_prior : Path, str, list or None, optional
+            Saved QUEST+ posterior(s) used as prior over the threshold. A single file warm starts from an earlier
+            session of the same participant, several files are averaged into a group prior. Defaults to None (flat prior).
+
+        QUEST_reset_shrinkage : float, optional
+            How far the posterior is moved towards the prior when QUEST is reset. 1 discards the posterior,
+            0 keeps it unchanged. Defaults to 1.0.
+
+        QUEST_posterior_dir : Path, str or None, optional
+            Directory to save the QUEST+ posterior to at the end of each block and of the session, as
+            <logfile stem>_block<N>.npy and <logfile stem>_session.npy. Defaults to None (not saved).
+        
         SGC_connector : object, optional
             Connector object for interfacing with the stimulation hardware. Defaults to None.
 
@@ -101,6 +140,11 @@ class Experiment:
         self.trigger_duration = trigger_duration
         self.countdown_timer = CountdownTimer() 
         self.events = []
+        self.blocks = []
+        self.break_duration = break_duration
+        self.rng = np.random.default_rng(seed)
+        self.clock = time.perf_counter # replaced when replaying a session faster than real time
+        self.schedule = schedule
 
         self.ISI_adjustment_factor = ISI_adjustment_factor
         
@@ -120,6 +164,13 @@ class Experiment:
         self.max_intensity_weak = intensities["salient"] - 0.5
         self.QUEST_plus = QUEST_plus
         self.QUEST_target = QUEST_target 
+        self.staircase = staircase if staircase else {}
+        self.intensity_grid = self.staircase.get("intensityVals", [round(intensity, 1) for intensity in np.arange(1.0, self.max_intensity_weak, 0.1)])
+        self.threshold_grid = self.staircase.get("thresholdVals", self.intensity_grid)
+        self.QUEST_prior = self.load_QUEST_prior(QUEST_prior)
+        self.QUEST_reset_shrinkage = QUEST_reset_shrinkage
+        self.QUEST_posterior_dir = Path(QUEST_posterior_dir) if QUEST_posterior_dir else None
+        self.prepared_QUEST = None
         self.QUEST_reset()
 
     def setup_experiment(self):
@@ -132,15 +183,24 @@ class Experiment:
             else:
                 reset = False
         
-            self.events.extend(self.event_sequence(self.n_sequences, ISI, block_idx, reset_QUEST=reset))
+            targets = self.schedule["blocks"][block_idx] if self.schedule else None
+        
+            self.blocks.append(self.event_sequence(self.n_sequences, ISI, block_idx, reset_QUEST=reset, targets=targets))
+            self.events.extend(self.blocks[-1])
         
-    def event_sequence(self, n_sequences, ISI, block_idx, n_salient=3, reset_QUEST: Union[int, None] = None) -> list[dict]:
+    def event_sequence(self, n_sequences, ISI, block_idx, n_salient=3, reset_QUEST: Union[int, None] = None, targets: Union[list, None] = None) -> list[dict]:
         """
         Generate a sequence of events for a block
 
         reset_QUEST: int or None
             If an integer, the QUEST procedure will be reset after this many sequences
+
+        targets: list or None
+            Target types to use for each sequence. If None, they are drawn using prop_target1_target2
         """
+        if targets is None:
+            targets = self.draw_targets(n_sequences)
+
         event_counter_in_block = 0
 
         events = []
@@ -150,50 +210,132 @@ class Experiment:
                 events.append({"ISI": ISI, "event_type": "stim/salient", "n_in_block": event_counter_in_block, "block": block_idx, "reset_QUEST": False})
             
             event_counter_in_block += 1
-            event_type = choice([self.target_1, self.target_2], 1, p=self.prop_target1_target2)
             
             if reset_QUEST and seq == reset_QUEST:  
                 reset = True
                 
             else:
                 reset = False
-            events.append({"ISI": ISI, "event_type": f"target/{event_type[0]}", "n_in_block": event_counter_in_block, "block": block_idx, "reset_QUEST": reset})
+            events.append({"ISI": ISI, "event_type": f"target/{targets[seq]}", "n_in_block": event_counter_in_block, "block": block_idx, "reset_QUEST": reset})
 
         return events
     
+    def draw_targets(self, n_sequences) -> list[str]:
+        """
+        Draw the target type of each sequence using the seeded random generator
+        """
+        return [str(target) for target in self.rng.choice([self.target_1, self.target_2], n_sequences, p=self.prop_target1_target2)]
 
     def QUEST_reset(self):
         """Reset the QUEST procedure."""
 
+        # use the handler (and its first proposed intensity) prepared during the break if there is one
+        if self.prepared_QUEST:
+            self.QUEST, self.intensities["weak"] = self.prepared_QUEST
+        else:
+            self.QUEST, self.intensities["weak"] = self.prepare_QUEST(self.reset_prior(getattr(self, "QUEST", None)))
+        self.prepared_QUEST = None
+        
+        print("QUEST has been reset")
+
+    def load_QUEST_prior(self, QUEST_prior) -> Union[np.ndarray, None]:
+        """Load the prior over the threshold grid from saved posterior(s), None for a flat prior."""
+        if isinstance(QUEST_prior, dict):
+            raise ValueError("A QUEST_prior per site is only supported by version B with per_site_QUEST")
+
+        return load_prior(QUEST_prior, self.threshold_grid) if QUEST_prior else None
+
+    def site_prior(self, site=None) -> Union[np.ndarray, None]:
+        """The prior over the threshold for the QUEST procedure of a site (the same for all sites by default)."""
+        return self.QUEST_prior
+
+    def reset_prior(self, QUEST=None, site=None) -> Union[np.ndarray, None]:
+        """
+        The prior over the threshold for a new QUEST handler replacing QUEST: the posterior of QUEST moved towards
+        the prior (of the site) by QUEST_reset_shrinkage, or just the prior if there is no posterior to keep.
+        """
+        QUEST_prior = self.site_prior(site)
+        if QUEST is None or not self.QUEST_plus or self.QUEST_reset_shrinkage >= 1:
+            return QUEST_prior
+
+        prior = QUEST_prior if QUEST_prior is not None else np.full(len(self.threshold_grid), 1 / len(self.threshold_grid))
+        return shrink(threshold_posterior(QUEST), prior, self.QUEST_reset_shrinkage)
+
+    def prepare_QUEST(self, prior: Union[np.ndarray, None] = None):
+        """Set up a new QUEST handler and compute its first proposed intensity."""
+        QUEST = self.make_QUEST(prior)
+        return QUEST, round(QUEST.next(), 1)
+
+    def make_QUEST(self, prior: Union[np.ndarray, None] = None):
+        """Set up a new QUEST handler, optionally with an informative prior over the threshold grid."""
+
+        start_val = self.QUEST_start_val
+        if prior is not None:
+            # start from the grid value closest to the expected threshold under the prior
+            expected = np.dot(self.threshold_grid, prior)
+            start_val = self.intensity_grid[int(np.argmin(np.abs(np.asarray(self.intensity_grid) - expected)))]
+
         if self.QUEST_plus:
             
-            self.QUEST = QuestPlusHandler(
-                startIntensity = self.QUEST_start_val,  # Initial guess for intensity
-                intensityVals = [round(intensity, 1) for intensity in np.arange(1.0, self.max_intensity_weak, 0.1)],
-                thresholdVals = [round(intensity, 1) for intensity in np.arange(1.0, self.max_intensity_weak, 0.1)],
-                stimScale = "linear",
-                responseVals = (1, 0), # success full, miss
-                nTrials=None,  # Total number of trials
-                slopeVals=2,  # Slope of the psychometric function?? (how much does intensity change)
-                lowerAsymptoteVals=0.5,  # Guess rate (e.g., 50% for a 2-alternative forced choice task)
-                lapseRateVals=0.05  # Lapse rate (probability of missing a stimulus even if it's detectable)
-            )
+            return QuestPlusHandler(**{
+                "startIntensity": start_val,  # Initial guess for intensity
+                "intensityVals": self.intensity_grid,
+                "thresholdVals": self.threshold_grid,
+                "stimScale": "linear",
+                "responseVals": (1, 0), # success full, miss
+                "nTrials": None,  # Total number of trials
+                "slopeVals": 2,  # Slope of the psychometric function?? (how much does intensity change)
+                "lowerAsymptoteVals": 0.5,  # Guess rate (e.g., 50% for a 2-alternative forced choice task)
+                "lapseRateVals": 0.05,  # Lapse rate (probability of missing a stimulus even if it's detectable)
+                **({"prior": {"threshold": prior}} if prior is not None else {}),
+                **self.staircase
+            })
         else:
-            self.QUEST = QuestHandler(
-            startVal=self.QUEST_start_val,  # Initial guess for intensity
-            startValSd=0.5,  # Standard deviation
-            minVal=1.0,
-            maxVal=self.max_intensity_weak,
-            pThreshold=self.QUEST_target,  # Target probability threshold (e.g., 75% detection)
-            stepType = "linear",
-            nTrials=100,  # Total number of trials
-            beta=3.5,  # Slope of the psychometric function
-            gamma=0.5,  # Guess rate (e.g., 50% for a 2-alternative forced choice task)
-            delta=0.01  # Lapse rate (probability of missing a stimulus even if it's detectable)
-        )
-        
+            return QuestHandler(**{
+            "startVal": start_val,  # Initial guess for intensity
+            "startValSd": 0.5,  # Standard deviation
+            "minVal": 1.0,
+            "maxVal": self.max_intensity_weak,
+            "pThreshold": self.QUEST_target,  # Target probability threshold (e.g., 75% detection)
+            "stepType": "linear",
+            "nTrials": 100,  # Total number of trials
+            "beta": 3.5,  # Slope of the psychometric function
+            "gamma": 0.5,  # Guess rate (e.g., 50% for a 2-alternative forced choice task)
+            "delta": 0.01,  # Lapse rate (probability of missing a stimulus even if it's detectable)
+            **self.staircase
+        })
+
+    def QUEST_posteriors(self) -> dict:
+        """
+        The current posterior over the threshold of each QUEST procedure, keyed by a label used in the file name
+        """
+        return {"": threshold_posterior(self.QUEST)}
+
+    def save_QUEST_posteriors(self, name: str):
+        """
+        Save the QUEST+ posteriors to QUEST_posterior_dir as <logfile stem>_<name>.npy (or <logfile stem>_<name>_<label>.npy),
+        so the posteriors of different sessions saved to the same directory are kept apart
+        """
+        if not self.QUEST_posterior_dir or not self.QUEST_plus:
+            return
+
+        name = f"{Path(self.logfile).stem}_{name}"
+        for label, posterior in self.QUEST_posteriors().items():
+            filename = f"{name}_{label}.npy" if label else f"{name}.npy"
+            save_posterior(self.QUEST_posterior_dir / filename, self.threshold_grid, posterior)
+
+    def update_QUEST(self, correct, intensity, event_type):
+        """
+        Add a response to the target event_type to the QUEST procedure and update the weak intensity
+        """
+        self.QUEST.addResponse(correct, intensity = intensity)
         self.update_weak_intensity()
-        print("QUEST has been reset")
+
+    def weak_intensity(self, event_type) -> float:
+        """
+        The intensity of the weak stimulation for the target event_type
+        """
+        return self.intensities["weak"]
 
     def update_weak_intensity(self):
         """
@@ -202,12 +344,36 @@ class Experiment:
         proposed_intensity = self.QUEST.next()
         self.intensities["weak"] = round(proposed_intensity, 1)
 
-    def deliver_stimulus(self, event_type):
+    def deliver_stimulus(self, event_type) -> Union[float, None]:
+        """
+        Deliver the stimulus of an event. Can return the clock time the stimulus was sent, which is logged as
+        the onset instead of the time after returning (e.g. when the stimulus is sent from another thread).
+        """
         pass
     
     def prepare_for_next_stimulus(self, event_type, next_event_type):
         pass
 
+    def prepare_for_block(self, events: list[dict]):
+        """
+        Prepare the stimulation hardware for the next block (called before every block, during the break if there is one)
+        """
+        pass
+
+    @contextmanager
+    def dispatching(self):
+        """
+        Context the stimuli are delivered in, e.g. to start and stop threads sending them (used around `loop_over_events`)
+        """
+        yield
+
+    def intensity_transitions(self) -> list[tuple]:
+        """
+        All intensity changes that can occur during a block: from the salient intensity to any weak intensity and back
+        """
+        salient = self.intensities["salient"]
+        return [(salient, weak) for weak in self.intensity_grid] + [(weak, salient) for weak in self.intensity_grid]
+
     def loop_over_events(self, events: list[dict], log_file):
         """
         Loop over the events in the experiment
@@ -218,13 +384,13 @@ class Experiment:
             elif "omis" in trial["event_type"]:
                 intensity = 0
             else:
-                intensity = self.intensities["weak"]
+                intensity = self.weak_intensity(trial["event_type"])
 
             #self.raise_and_lower_trigger(trigger)  # Send trigger
             # deliver pulse
-            self.deliver_stimulus(trial["event_type"])
+            onset = self.deliver_stimulus(trial["event_type"])
             
-            event_time = time.perf_counter() - self.start_time
+            event_time = (self.clock() if onset is None else onset) - self.start_time
             
             self.log_event(
                 **trial,
@@ -248,7 +414,10 @@ class Experiment:
             except IndexError:
                 pass
 
-            while time.perf_counter() < target_time:
+            while self.clock() < target_time:
+                # yield the GIL so other threads (e.g. the writer threads of the pulse dispatcher) are not held up
+                time.sleep(0)
+
                 # check for key press during target window
                 if self.listener.active and not response_given:
                     key = self.listener.get_response()
@@ -257,11 +426,12 @@ class Experiment:
                         print(f"Response: {key}, Correct: {correct}")
                         self.raise_and_lower_trigger(response_trigger) 
                         response_given = True
+                        target_type = trial["event_type"]
                         trial["event_type"] = "response"
                         
                         self.log_event(
                             **trial,
-                            event_time=time.perf_counter() - self.start_time, 
+                            event_time=self.clock() - self.start_time, 
                             intensity=intensity, 
                             trigger=response_trigger, 
                             correct=correct, 
@@ -269,8 +439,7 @@ class Experiment:
                             )
                         
                         if intensity != 0: # only update QUEST if the stimulus was not a omisson
-                            self.QUEST.addResponse(correct, intensity = intensity)
-                            self.update_weak_intensity()
+                            self.update_QUEST(correct, intensity, target_type)
 
                         # check if QUEST should be reset
                         if trial["reset_QUEST"]:
@@ -279,14 +448,45 @@ class Experiment:
             # stop listening for responses
             self.listener.active = False
 
+    def write_log_header(self, log_file):
+        log_file.write("time,block,ISI,intensity,event_type,trigger,n_in_block,correct, QUEST_reset\n")
+
     def log_event(self, event_time, block, ISI, intensity, event_type, trigger, n_in_block, correct, reset_QUEST, log_file):
         log_file.write(f"{event_time},{block},{ISI},{intensity},{event_type},{trigger},{n_in_block},{correct}, {reset_QUEST}\n")
     
+    def take_break(self, events: list[dict], log_file):
+        """
+        Break between blocks used to prepare the next block. The break lasts at least break_duration seconds,
+        or as long as the preparation takes.
+        """
+        break_start = time.perf_counter()
+        print("Break")
+
+        # write the log of the previous block to disk
+        log_file.flush()
+        os.fsync(log_file.fileno())
+
+        # set up the QUEST handler in advance if it will be reset during the block
+        # (not possible if the new prior depends on the posterior at the time of the reset)
+        if any(event["reset_QUEST"] for event in events) and self.QUEST_reset_shrinkage >= 1:
+            self.prepared_QUEST = self.prepare_QUEST(self.reset_prior())
+
+        # position the connectors at the salient intensity and precompute the intensity changes
+        self.prepare_for_block(events)
+
+        gc.collect()
+
+        preparation_time = time.perf_counter() - break_start
+        time.sleep(max(0, self.break_duration - preparation_time))
+
+        print(f"Break done after {round(time.perf_counter() - break_start, 2)} s ({round(preparation_time, 3)} s preparation)")
+
     def determine_respiratory_rate(self, log_file):
         """
         Runs a set of sequences with same ISI as block B to determine respiratory rate during task.
         """
-        events = self.event_sequence(self.resp_n_sequences, self.ISIs[1], block_idx="det_respiratory_rate")
+        targets = self.schedule["det_respiratory_rate"] if self.schedule else None
+        events = self.event_sequence(self.resp_n_sequences, self.ISIs[1], block_idx="det_respiratory_rate", targets=targets)
         self.loop_over_events(events, log_file)
 
         while True:
@@ -370,21 +570,29 @@ class Experiment:
     
     def run(self):
 
-        # NOTE! WRITE TO LOG FILE IN THE BREAKS?
-
         self.listener.start_listener()  # Start the keyboard listener
         self.logfile.parent.mkdir(parents=True, exist_ok=True)  # Ensure log directory exists
 
-        self.start_time = time.perf_counter()
+        self.start_time = self.clock()
        
-        with open(self.logfile, 'w') as log_file:
-            log_file.write("time,block,ISI,intensity,event_type,trigger,n_in_block,correct, QUEST_reset\n")
+        with self.dispatching(), open(self.logfile, 'w') as log_file:
+            self.write_log_header(log_file)
             
             # determine the respiratory rate during block B
             self.determine_respiratory_rate(log_file)
 
             # run the experiment
             self.setup_experiment()
-            self.loop_over_events(self.events, log_file)
+            for events in self.blocks:
+                if self.break_duration:
+                    self.take_break(events, log_file)
+                else:
+                    # the last event of the previous block may have left a connector at the weak intensity
+                    self.prepare_for_block(events)
+
+                self.loop_over_events(events, log_file)
+                self.save_QUEST_posteriors(f"block{events[0]['block']}")
+
+            self.save_QUEST_posteriors("session")
 
         self.listener.stop_listener()  # Stop the keyboard listener
\ No newline at end of file
@@ -0,0 +1,27 @@
+"""
+Description: Reading of the session logs written by `Experiment.log_event`.
+"""
+
+from pathlib import Path
+
+import pandas as pd
+
+
+def read_session_log(path: Path) -> pd.DataFrame:
+    """
+    Read a session log. Numeric block indices are converted to integers, leaving e.g. "det_respiratory_rate" as is.
+    """
+    df = pd.read_csv(path, skipinitialspace=True)
+    df["block"] = [int(block) if str(block).isdigit() else block for block in df["block"]]
+
+    return df
+
+
+def onset_errors(df: pd.DataFrame) -> pd.Series:
+    """
+    Deviation of each stimulus onset from the onset scheduled by the previous event within the same block.
+    """
+    stimuli = df[df["event_type"] != "response"]
+    scheduled = stimuli.groupby("block", sort=False)["time"].shift() + stimuli.groupby("block", sort=False)["ISI"].shift()
+
+    return stimuli["time"] - scheduled
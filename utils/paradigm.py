@@ -0,0 +1,239 @@
+"""
+Description: Loading of declarative paradigm specifications (JSON or TOML) and compiling them into
+the trigger table, event schedule, staircase configuration and connector setup used by the experiments.
+Compiled paradigms are cached on disk keyed by the content hash of the spec and the seed.
+"""
+
+from pathlib import Path
+import hashlib
+import json
+import tomllib
+from typing import Union
+
+import numpy as np
+
+from .SGC_connector import SGCConnector, SGCFakeConnector
+
+
+CACHE_DIR = Path(".paradigm_cache")
+
+# part of the cache key, increase when the compiled output changes so stale artefacts are not reused
+COMPILER_VERSION = 3
+
+# target types and the name of the proportion argument for each version of the experiment
+EXPERIMENTS = {
+    "A": {"targets": ["weak", "omis"], "prop": "prop_weak_omis"},
+    "B": {"targets": ["left", "right"], "prop": "prop_left_right"},
+}
+
+REQUIRED_DESIGN = ["order", "n_sequences", "resp_n_sequences"]
+
+# shared staircase keys of the spec and the corresponding QuestHandler argument when QUEST+ is not used
+QUEST_ARGUMENTS = {
+    "min_intensity": "minVal",
+    "max_intensity": "maxVal",
+}
+
+# QuestPlusHandler arguments that should not be passed to QuestHandler. The psychometric function is
+# parameterised differently, so e.g. slopeVals is not the same as beta and settings are not carried over.
+QUEST_PLUS_ONLY = [
+    "intensityVals", "thresholdVals", "slopeVals", "lowerAsymptoteVals", "lapseRateVals", "responseVals",
+    "stimScale", "startIntensity", "prior", "psychometricFunc", "stimSelectionMethod", "stimSelectionOptions",
+    "paramEstimationMethod",
+]
+
+
+def load_spec(path: Path) -> dict:
+    """
+    Load a paradigm specification from a .json or .toml file.
+    """
+    path = Path(path)
+    if path.suffix == ".toml":
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    elif path.suffix == ".json":
+        with open(path, "r") as f:
+            return json.load(f)
+    else:
+        raise ValueError(f"Unsupported paradigm spec format: {path.suffix} (use .json or .toml)")
+
+
+def spec_hash(spec: dict, seed: int) -> str:
+    """
+    Content hash of a spec, seed and compiler version, independent of key order and file format.
+    """
+    canonical = json.dumps({"spec": spec, "seed": seed, "compiler_version": COMPILER_VERSION}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def compile_trigger_mapping(triggers: dict) -> dict:
+    """
+    Compile the trigger table from named bits and the bits making up each event code.
+
+    Parameters
+    ----------
+    triggers : dict
+        {"bits": {name: value}, "codes": {event_type: [bit names]}}
+    """
+    bits = triggers["bits"]
+    trigger_mapping = {}
+    for event_type, names in triggers["codes"].items():
+        unknown = [name for name in names if name not in bits]
+        if unknown:
+            raise ValueError(f"Unknown trigger bits {unknown} for {event_type}")
+        trigger_mapping[event_type] = int(sum(bits[name] for name in names))
+
+    return trigger_mapping
+
+
+def compile_staircase(staircase: dict, intensities: dict, QUEST_plus: bool) -> dict:
+    """
+    Compile the staircase configuration into keyword arguments for the QUEST handler.
+
+    The shared keys min_intensity, max_intensity and step apply to both procedures. Arguments specific to the
+    QuestPlusHandler or QuestHandler go in the "QUEST_plus" and "QUEST" tables, only the one in use is passed on.
+    For QUEST+ the intensity and threshold grids are precomputed from min_intensity, max_intensity and step.
+    For QUEST the intensity range is renamed to the QuestHandler arguments (see QUEST_ARGUMENTS), and step is not used.
+    """
+    staircase = dict(staircase)
+    QUEST_plus_arguments = staircase.pop("QUEST_plus", {})
+    QUEST_arguments = staircase.pop("QUEST", {})
+
+    if not QUEST_plus:
+        staircase.pop("step", None)
+        unsupported = [key for key in staircase if key in QUEST_PLUS_ONLY]
+        if unsupported:
+            raise ValueError(f"The staircase keys {unsupported} are only supported with QUEST_plus = true (put them in the staircase.QUEST_plus table)")
+
+        return {**{QUEST_ARGUMENTS.get(key, key): value for key, value in staircase.items()}, **QUEST_arguments}
+
+    min_intensity = staircase.pop("min_intensity", 1.0)
+    max_intensity = staircase.pop("max_intensity", intensities["salient"] - 0.5)
+    step = staircase.pop("step", 0.1)
+    grid = [round(float(intensity), 1) for intensity in np.arange(min_intensity, max_intensity, step)]
+
+    return {"intensityVals": grid, "thresholdVals": grid, **staircase, **QUEST_plus_arguments}
+
+
+def compile_schedule(design: dict, targets: list, prop: list, seed: int) -> dict:
+    """
+    Draw the target type of every sequence in the session.
+    """
+    rng = np.random.default_rng(seed)
+
+    def draw(n_sequences):
+        return [str(target) for target in rng.choice(targets, n_sequences, p=prop)]
+
+    return {
+        "det_respiratory_rate": draw(design["resp_n_sequences"]),
+        "blocks": [draw(design["n_sequences"]) for _ in design["order"]],
+    }
+
+
+def compile_spec(spec: dict, seed: int) -> dict:
+    """
+    Compile a paradigm specification into everything needed to set up the experiment.
+
+    Parameters
+    ----------
+    spec : dict
+        Paradigm specification with the keys "experiment" ("A" or "B"), "triggers", "intensities",
+        "design" (constructor arguments), and optionally "staircase" and "connectors".
+    seed : int
+        Seed used for drawing the event schedule.
+
+    Returns
+    -------
+    dict
+        The compiled paradigm. The "experiment_kwargs" can be passed directly to the experiment class.
+    """
+    if spec["experiment"] not in EXPERIMENTS:
+        raise ValueError(f"Unknown experiment {spec['experiment']}, should be one of {list(EXPERIMENTS)}")
+    experiment = EXPERIMENTS[spec["experiment"]]
+
+    design = dict(spec["design"])
+    missing = [key for key in REQUIRED_DESIGN + [experiment["prop"]] if key not in design]
+    if missing:
+        raise ValueError(f"Missing {missing} in the design of the paradigm spec")
+
+    intensities = dict(spec["intensities"])
+    QUEST_plus = design.get("QUEST_plus", True)
+
+    return {
+        "hash": spec_hash(spec, seed),
+        "seed": seed,
+        "experiment": spec["experiment"],
+        "trigger_mapping": compile_trigger_mapping(spec["triggers"]),
+        "experiment_kwargs": {**design, "intensities": intensities, "seed": seed},
+        "staircase": compile_staircase(spec.get("staircase", {}), intensities, QUEST_plus),
+        "schedule": compile_schedule(design, experiment["targets"], design[experiment["prop"]], seed),
+        "connectors": spec.get("connectors", {}),
+    }
+
+
+def compile_cached(path: Path, seed: int, cache_dir: Path = CACHE_DIR) -> dict:
+    """
+    Load and compile a paradigm spec, reusing the compiled artefact from the cache if the spec and seed are unchanged.
+    """
+    spec = load_spec(path)
+    cache_file = Path(cache_dir) / f"{spec_hash(spec, seed)}.json"
+
+    if cache_file.exists():
+        with open(cache_file, "r") as f:
+            return json.load(f)
+
+    compiled = compile_spec(spec, seed)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file, "w") as f:
+        json.dump(compiled, f, indent=2)
+
+    return compiled
+
+
+def write_session_record(logfile: Path, spec_path: Path, compiled: dict) -> Path:
+    """
+    Write the spec, seed and hash of the compiled paradigm to <logfile stem>_paradigm.json next to the session log,
+    so the session can be recompiled (or found in the cache) from its log.
+    """
+    logfile = Path(logfile)
+    record_path = logfile.with_name(f"{logfile.stem}_paradigm.json")
+    record_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(record_path, "w") as f:
+        json.dump({
+            "spec": str(spec_path),
+            "seed": compiled["seed"],
+            "hash": compiled["hash"],
+            "compiler_version": COMPILER_VERSION,
+        }, f, indent=2)
+
+    return record_path
+
+
+def make_connectors(compiled: dict, intensity_codes_path: Union[Path, None] = None) -> dict:
+    """
+    Set up the SGC connectors described in a compiled paradigm.
+
+    Each connector entry can contain "type" ("serial" or "fake"), "port", "start_intensity",
+    "pulse_duration", "trigger_delay" and "initial_intensity" (name of the intensity to change to after connecting).
+    """
+    connectors = {}
+    for name, settings in compiled["connectors"].items():
+        codes_path = Path(settings.get("intensity_codes_path", intensity_codes_path or "intensity_code.csv"))
+        start_intensity = settings.get("start_intensity", 1)
+
+        if settings.get("type", "serial") == "serial":
+            connector = SGCConnector(port=settings["port"], intensity_codes_path=codes_path, start_intensity=start_intensity)
+        else:
+            connector = SGCFakeConnector(intensity_codes_path=codes_path, start_intensity=start_intensity)
+
+        if "pulse_duration" in settings:
+            connector.set_pulse_duration(settings["pulse_duration"])
+        if "trigger_delay" in settings:
+            connector.set_trigger_delay(settings["trigger_delay"])
+        if "initial_intensity" in settings:
+            connector.change_intensity(compiled["experiment_kwargs"]["intensities"][settings["initial_intensity"]])
+
+        connectors[name] = connector
+
+    return connectors
@@ -0,0 +1,61 @@
+"""
+Description: Saving and loading of QUEST+ posteriors over the threshold grid, so they can be reused as an
+informative prior for the same participant (warm start) or combined into a group prior.
+The posteriors are stored as .npy files with the threshold grid in the first row and the probabilities in the second.
+"""
+
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+
+def threshold_posterior(QUEST) -> np.ndarray:
+    """
+    Marginal posterior over the threshold grid of a QuestPlusHandler (its posterior is a dict of marginals per parameter).
+    """
+    return np.asarray(QUEST.posterior["threshold"], dtype=float)
+
+
+def normalise(probabilities: np.ndarray) -> np.ndarray:
+    """
+    Normalise to sum to one, falling back to a flat distribution if everything is zero.
+    """
+    probabilities = np.asarray(probabilities, dtype=float)
+    total = probabilities.sum()
+    if total <= 0:
+        return np.full(len(probabilities), 1 / len(probabilities))
+
+    return probabilities / total
+
+
+def save_posterior(path: Path, thresholds: list, probabilities: np.ndarray):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    np.save(path, np.stack([np.asarray(thresholds, dtype=np.float32), np.asarray(probabilities, dtype=np.float32)]))
+
+
+def load_posterior(path: Path, thresholds: list) -> np.ndarray:
+    """
+    Load a saved posterior and interpolate it onto the given threshold grid.
+    """
+    saved = np.load(path, mmap_mode="r")
+
+    return normalise(np.interp(thresholds, saved[0], saved[1], left=0, right=0))
+
+
+def load_prior(paths: Union[Path, str, list], thresholds: list) -> np.ndarray:
+    """
+    Prior over the threshold grid from one saved posterior (warm start) or the average of several (group prior).
+    """
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+
+    return normalise(np.mean([load_posterior(path, thresholds) for path in paths], axis=0))
+
+
+def shrink(posterior: np.ndarray, prior: np.ndarray, shrinkage: float) -> np.ndarray:
+    """
+    Move the posterior towards the prior. A shrinkage of 1 returns the prior, 0 keeps the posterior.
+    """
+    return normalise((1 - shrinkage) * np.asarray(posterior) + shrinkage * np.asarray(prior))
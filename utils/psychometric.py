@@ -0,0 +1,217 @@
+"""
+Description: Offline fitting of psychometric functions to the responses of all sessions at once. The responses are
+counted per intensity level, so the log-likelihood over a dense (threshold x slope) grid can be computed for all
+sessions and ISI conditions in one go. Confidence intervals are obtained by bootstrapping the trials.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+import pandas as pd
+
+from .logs import read_session_log
+
+
+# same assumptions as the QUEST+ procedure used during the experiment
+GUESS_RATE = 0.5
+LAPSE_RATE = 0.05
+
+
+def weibull(intensity, threshold, slope, guess_rate: float = GUESS_RATE, lapse_rate: float = LAPSE_RATE):
+    """Probability of a correct response (Weibull on a linear intensity scale)."""
+    return 1 - lapse_rate - (1 - guess_rate - lapse_rate) * np.exp(-(intensity / threshold) ** slope)
+
+
+def inverse_weibull(p: float, threshold, slope, guess_rate: float = GUESS_RATE, lapse_rate: float = LAPSE_RATE):
+    """Intensity at which the probability of a correct response is p."""
+    return threshold * (-np.log((1 - lapse_rate - p) / (1 - guess_rate - lapse_rate))) ** (1 / slope)
+
+
+def read_session_trials(path: Path) -> pd.DataFrame:
+    """
+    Read the responses to weak targets from a session log, labelled with the ISI condition (A, B or C)
+    and the target site (e.g. left or right, taken from the target the response follows).
+
+    The conditions are determined from the ISIs used in the session: A has the shortest and C the longest ISI.
+    The block used to determine the respiratory rate has the ISI of B and is included in B.
+    """
+    df = read_session_log(path)
+    is_target = df["event_type"].str.startswith("target")
+    site = df["event_type"].where(is_target).ffill().str.split("/").str[-1]
+    responses = df[(df["event_type"] == "response") & (df["intensity"] > 0)]
+
+    ISIs = sorted(df["ISI"].round(6).unique())
+    labels = ["A", "B", "C"] if len(ISIs) == 3 else [f"ISI={ISI}" for ISI in ISIs]
+    condition = dict(zip(ISIs, labels))
+
+    return pd.DataFrame({
+        "session": str(path),
+        "condition": responses["ISI"].round(6).map(condition).values,
+        "site": site[responses.index].values,
+        "intensity": responses["intensity"].round(1).values,
+        "correct": responses["correct"].astype(int).values,
+    })
+
+
+def count_responses(trials: pd.DataFrame) -> tuple[pd.DataFrame, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count the correct and total responses per intensity level for each session, condition and site.
+
+    Returns
+    -------
+    groups : pd.DataFrame
+        The session, condition and site of each group.
+    levels : np.ndarray
+        The intensity levels (L).
+    k : np.ndarray
+        Correct responses per group and level (G x L).
+    n : np.ndarray
+        Responses per group and level (G x L).
+    """
+    counts = trials.groupby(["session", "condition", "site", "intensity"])["correct"].agg(["sum", "count"])
+    k = counts["sum"].unstack("intensity", fill_value=0)
+    n = counts["count"].unstack("intensity", fill_value=0)
+
+    return k.index.to_frame(index=False), k.columns.to_numpy(dtype=float), k.to_numpy(dtype=float), n.to_numpy(dtype=float)
+
+
+def grid_log_probabilities(levels: np.ndarray, thresholds: np.ndarray, slopes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Log-probability of a correct and an incorrect response at each level for every (threshold, slope) on the grid ((T * S) x L).
+    """
+    p = weibull(levels[None, None, :], thresholds[:, None, None], slopes[None, :, None]).reshape(-1, len(levels))
+
+    return np.log(p), np.log(1 - p)
+
+
+def grid_fit(k: np.ndarray, n: np.ndarray, log_p: np.ndarray, log_q: np.ndarray, thresholds: np.ndarray, slopes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Maximum likelihood threshold and slope on the grid for each group, from the binomial log-likelihood
+    of all grid points at once (G x (T * S)).
+    """
+    loglik = k @ log_p.T + (n - k) @ log_q.T
+    t_idx, s_idx = np.unravel_index(np.argmax(loglik, axis=1), (len(thresholds), len(slopes)))
+
+    return thresholds[t_idx], slopes[s_idx]
+
+
+def bootstrap_counts(k: np.ndarray, n: np.ndarray, n_boot: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Resample the trials of one group with replacement n_boot times.
+
+    Returns
+    -------
+    k_boot, n_boot : np.ndarray
+        Correct and total responses per level for each bootstrap sample (n_boot x L).
+    """
+    cells = np.concatenate([k, n - k])
+    resampled = rng.multinomial(int(n.sum()), cells / cells.sum(), size=n_boot)
+    k_boot = resampled[:, :len(k)]
+
+    return k_boot, k_boot + resampled[:, len(k):]
+
+
+def fit_chunk(k, n, levels, thresholds, slopes, n_boot: int, seeds: list, target: float, boot_chunk: int = 500) -> np.ndarray:
+    """
+    Fit a chunk of groups with bootstrap confidence intervals.
+
+    Returns
+    -------
+    np.ndarray
+        Per group: threshold, slope, intensity at the target, and the 2.5 and 97.5 percentiles of the
+        bootstrapped threshold and intensity at the target.
+    """
+    log_p, log_q = grid_log_probabilities(levels, thresholds, slopes)
+    threshold, slope = grid_fit(k, n, log_p, log_q, thresholds, slopes)
+    x_target = inverse_weibull(target, threshold, slope)
+
+    ci = np.full((len(k), 4), np.nan)
+    if n_boot:
+        # draw the samples per group (own random stream), then fit all groups and samples together
+        samples = [bootstrap_counts(k[g], n[g], n_boot, np.random.default_rng(seeds[g])) for g in range(len(k))]
+        k_boot = np.concatenate([k_g for k_g, _ in samples]).astype(float)
+        n_boot_counts = np.concatenate([n_g for _, n_g in samples]).astype(float)
+
+        boot_threshold = np.empty(len(k_boot))
+        boot_slope = np.empty(len(k_boot))
+        for start in range(0, len(k_boot), boot_chunk):
+            end = start + boot_chunk
+            boot_threshold[start:end], boot_slope[start:end] = grid_fit(k_boot[start:end], n_boot_counts[start:end], log_p, log_q, thresholds, slopes)
+
+        boot_threshold = boot_threshold.reshape(len(k), n_boot)
+        boot_x_target = inverse_weibull(target, boot_threshold, boot_slope.reshape(len(k), n_boot))
+        ci = np.concatenate([
+            np.percentile(boot_threshold, [2.5, 97.5], axis=1).T,
+            np.percentile(boot_x_target, [2.5, 97.5], axis=1).T,
+        ], axis=1)
+
+    return np.column_stack([threshold, slope, x_target, ci])
+
+
+def fit_psychometric(
+        trials: pd.DataFrame,
+        thresholds: Union[np.ndarray, None] = None,
+        slopes: Union[np.ndarray, None] = None,
+        n_boot: int = 1000,
+        target: float = 0.75,
+        n_jobs: int = 1,
+        chunk_size: int = 16,
+        seed: int = 0,
+        ) -> pd.DataFrame:
+    """
+    Fit a psychometric function to each session, condition and site.
+
+    Parameters
+    ----------
+    trials : pd.DataFrame
+        Trials with the columns session, condition, site, intensity and correct (see `read_session_trials`).
+    thresholds, slopes : np.ndarray or None
+        The parameter grid. Defaults to 200 thresholds between 0.5 and 1.5 times the intensity range and 40 slopes between 0.5 and 10.
+    n_boot : int
+        Number of bootstrap samples for the confidence intervals (0 to skip).
+    target : float
+        Proportion correct to report the intensity for (the QUEST target).
+    n_jobs : int
+        Number of processes. The groups are split into chunks of chunk_size.
+    seed : int
+        Seed for the bootstrap. Each group gets its own stream, so the results do not depend on n_jobs.
+    """
+    groups, levels, k, n = count_responses(trials)
+
+    if thresholds is None:
+        thresholds = np.linspace(0.5 * levels.min(), 1.5 * levels.max(), 200)
+    if slopes is None:
+        slopes = np.geomspace(0.5, 10, 40)
+
+    seeds = np.random.SeedSequence(seed).spawn(len(k))
+    chunks = [slice(start, start + chunk_size) for start in range(0, len(k), chunk_size)]
+    args = [(k[c], n[c], levels, thresholds, slopes, n_boot, seeds[c], target) for c in chunks]
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(fit_chunk, *zip(*args)))
+    else:
+        results = [fit_chunk(*arg) for arg in args]
+
+    fits = pd.DataFrame(np.concatenate(results), columns=[
+        "threshold", "slope", "x_target",
+        "threshold_ci_low", "threshold_ci_high", "x_target_ci_low", "x_target_ci_high",
+    ])
+    fits.insert(0, "n_trials", n.sum(axis=1).astype(int))
+
+    return pd.concat([groups, fits], axis=1)
+
+
+def read_all_trials(paths: list, n_jobs: int = 1) -> pd.DataFrame:
+    """
+    Read the trials of all session logs.
+    """
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            trials = list(executor.map(read_session_trials, paths))
+    else:
+        trials = [read_session_trials(path) for path in paths]
+
+    return pd.concat(trials, ignore_index=True)
@@ -0,0 +1,154 @@
+"""
+Description: Deterministic replay of a logged session. The schedule and the response timings are read from
+a session log (as written by `Experiment.log_event`) and used to re-drive `Experiment.loop_over_events`
+with scripted responses, either in real time or as fast as possible. The new log can then be compared
+to the original to isolate timing anomalies and differences in the QUEST trajectory.
+"""
+
+from pathlib import Path
+import time
+
+import numpy as np
+import pandas as pd
+
+from .logs import onset_errors, read_session_log
+from .responses import ScriptedListener
+
+
+class ReplayClock:
+    """
+    Clock that runs ahead of real time by `tick` seconds on every call, so busy-waiting on the
+    ISI finishes quickly while the real processing time of each event is still included.
+    """
+    def __init__(self, tick: float = 0.001):
+        self.tick = tick
+        self.offset = 0.0
+
+    def __call__(self):
+        self.offset += self.tick
+        return time.perf_counter() + self.offset
+
+
+def session_events(df: pd.DataFrame) -> list[dict]:
+    """
+    Reconstruct the events passed to `loop_over_events` from the stimulus rows of a session log.
+    """
+    stimuli = df[df["event_type"] != "response"]
+
+    return [
+        {
+            "ISI": float(row.ISI),
+            "event_type": row.event_type,
+            "n_in_block": int(row.n_in_block),
+            "block": row.block,
+            "reset_QUEST": bool(row.QUEST_reset),
+        }
+        for row in stimuli.itertuples()
+    ]
+
+
+def session_responses(df: pd.DataFrame, keys_target: dict) -> list:
+    """
+    Reconstruct the response to each target event as (latency, key), or None if no response was given.
+
+    The key is chosen from keys_target: the first key of the presented target for correct responses
+    and the first key of the other target for incorrect responses.
+    """
+    responses = []
+    rows = list(df.itertuples())
+    for i, row in enumerate(rows):
+        if not row.event_type.startswith("target"):
+            continue
+
+        next_row = rows[i + 1] if i + 1 < len(rows) else None
+        if next_row is None or next_row.event_type != "response":
+            responses.append(None)
+            continue
+
+        target = row.event_type.split("/")[-1]
+        other = [name for name in keys_target if name != target][0]
+        key = keys_target[target][0] if next_row.correct == 1 else keys_target[other][0]
+        responses.append((next_row.time - row.time, key))
+
+    return responses
+
+
+def replay_session(experiment, log_path: Path, out_path: Path, realtime: bool = False, tick: float = 0.001) -> pd.DataFrame:
+    """
+    Replay a logged session with the given experiment and compare the result to the original.
+
+    The experiment should be constructed with the same intensities and staircase settings as the original
+    session, and with simulated connectors.
+
+    Parameters
+    ----------
+    experiment : Experiment
+        The experiment used to re-drive the events.
+    log_path : Path
+        The original session log.
+    out_path : Path
+        Where to write the log of the replayed session.
+    realtime : bool
+        If True the events are replayed at real-time speed, otherwise as fast as possible.
+    tick : float
+        Time skipped per clock call when not replaying in real time.
+
+    Returns
+    -------
+    pd.DataFrame
+        Per-event comparison of the original and the replayed session (see `diff_sessions`).
+    """
+    original = read_session_log(log_path)
+
+    experiment.clock = time.perf_counter if realtime else ReplayClock(tick)
+    experiment.listener = ScriptedListener(session_responses(original, experiment.keys_target), clock=experiment.clock)
+
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    experiment.start_time = experiment.clock()
+    with open(out_path, "w") as log_file:
+        experiment.write_log_header(log_file)
+        experiment.loop_over_events(session_events(original), log_file)
+
+    return diff_sessions(original, read_session_log(out_path))
+
+
+def diff_sessions(original: pd.DataFrame, replayed: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compare the per-event timing and the QUEST trajectory (the intensities) of two sessions with the same schedule.
+    """
+    stim_original = original[original["event_type"] != "response"]
+    stim_replayed = replayed[replayed["event_type"] != "response"]
+
+    if len(stim_original) != len(stim_replayed):
+        raise ValueError(f"The sessions do not have the same number of events ({len(stim_original)} vs {len(stim_replayed)})")
+
+    diff = pd.DataFrame({
+        "block": stim_original["block"].values,
+        "n_in_block": stim_original["n_in_block"].values,
+        "event_type": stim_original["event_type"].values,
+        "onset_error_original": onset_errors(original).values,
+        "onset_error_replay": onset_errors(replayed).values,
+        "intensity_original": stim_original["intensity"].values,
+        "intensity_replay": stim_replayed["intensity"].values,
+    })
+    diff["onset_error_change"] = diff["onset_error_replay"] - diff["onset_error_original"]
+    diff["intensity_match"] = np.isclose(diff["intensity_original"], diff["intensity_replay"])
+
+    return diff
+
+
+def summarise_diff(diff: pd.DataFrame):
+    """
+    Print a short summary of a session comparison.
+    """
+    for column in ["onset_error_original", "onset_error_replay"]:
+        errors = diff[column].abs()
+        print(f"{column} — Mean: {round(errors.mean(), 4)}, Max: {round(errors.max(), 4)}")
+
+    mismatches = diff[~diff["intensity_match"]]
+    if len(mismatches):
+        first = mismatches.iloc[0]
+        print(f"QUEST trajectory differs for {len(mismatches)} events, first in block {first['block']} (event {first['n_in_block']})")
+    else:
+        print("QUEST trajectory is identical")
@@ -1,4 +1,5 @@
 from pynput import keyboard
+import time
 
 class KeyboardListener:
     """A class to listen for keyboard inputs."""
@@ -29,4 +30,56 @@ class KeyboardListener:
         response = self.key_pressed
         self.key_pressed = None  # Reset after capturing
         
-        return response
\ No newline at end of file
+        return response
+
+
+class ScriptedListener:
+    """A drop-in replacement for KeyboardListener that replays scripted responses."""
+
+    def __init__(self, responses, clock=time.perf_counter):
+        """
+        Parameters
+        ----------
+        responses : list
+            One entry per target event, in order. Each entry is either None (no response)
+            or a tuple (latency, key) with the latency in seconds relative to the target onset.
+        clock : callable
+            The clock used by the experiment.
+        """
+        self.responses = list(responses)
+        self.clock = clock
+        self._active = False
+        self.key_pending = None
+        self.release_time = None
+
+    @property
+    def active(self):
+        return self._active
+
+    @active.setter
+    def active(self, value):
+        """Activating the listener starts the next scripted response."""
+        if value and not self._active:
+            response = self.responses.pop(0) if self.responses else None
+            if response is not None:
+                latency, self.key_pending = response
+                self.release_time = self.clock() + latency
+        elif not value:
+            self.key_pending = None
+
+        self._active = value
+
+    def start_listener(self):
+        pass
+
+    def stop_listener(self):
+        pass
+
+    def get_response(self):
+        """Return the scripted key once its latency has passed."""
+        if self.key_pending is not None and self.clock() >= self.release_time:
+            response = self.key_pending
+            self.key_pending = None
+            return response
+
+        return None
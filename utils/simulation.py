@@ -0,0 +1,41 @@
+"""
+Description: Set up the experiments described by compiled paradigms with simulated connectors (or the given ones),
+as used by the replay and stress modes.
+"""
+
+from pathlib import Path
+from typing import Union
+
+# the experiment classes are defined in the scripts at the top level of the repository (run from there)
+from experiment_A import Experiment_A
+from experiment_B import Experiment_B
+
+from .SGC_connector import SGCFakeConnector
+
+
+def make_simulated_experiment(paradigm: dict, connectors: Union[dict, None] = None, intensity_codes_path: Path = Path("intensity_code.csv"), concurrent_dispatch: Union[bool, None] = None):
+    """
+    Set up the experiment described by a compiled paradigm, with simulated connectors unless connectors are given.
+    concurrent_dispatch overrides the setting of the paradigm for version B (if not None).
+    """
+    if connectors is None:
+        connectors = {
+            name: SGCFakeConnector(intensity_codes_path=intensity_codes_path, start_intensity=settings.get("start_intensity", 1), verbose=False)
+            for name, settings in paradigm["connectors"].items()
+        }
+    for connector in connectors.values():
+        connector.change_intensity(paradigm["experiment_kwargs"]["intensities"]["salient"])
+
+    kwargs = dict(
+        **paradigm["experiment_kwargs"],
+        trigger_mapping=paradigm["trigger_mapping"],
+        staircase=paradigm["staircase"],
+    )
+
+    if paradigm["experiment"] == "A":
+        connector, = connectors.values()
+        return Experiment_A(**kwargs, SGC_connector=connector)
+    else:
+        if concurrent_dispatch is not None:
+            kwargs["concurrent_dispatch"] = concurrent_dispatch
+        return Experiment_B(**kwargs, SGC_connectors=connectors)
@@ -0,0 +1,166 @@
+"""
+Description: Stress mode for finding the throughput ceiling of the paradigm. The ISI is swept downwards (and the
+number of sequences upwards) with scripted responses, and the onset error and the time spent in each stage
+(serial, trigger, staircase, logging) are measured per event.
+"""
+
+import io
+import threading
+import time
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+from .logs import onset_errors, read_session_log
+from .responses import ScriptedListener
+
+
+STAGES = ["serial", "trigger", "staircase", "logging"]
+
+
+class StageTimer:
+    """
+    Records the time spent in each stage for every event. A new event starts each time the experiment delivers a stimulus.
+    With concurrent dispatch the serial commands are sent from the writer threads, and their time is summed over the sites.
+    """
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def new_event(self):
+        with self.lock:
+            self.events.append(dict.fromkeys(STAGES, 0.0))
+
+    def timed(self, stage: str, func: Callable) -> Callable:
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = func(*args, **kwargs)
+            with self.lock:
+                if self.events:
+                    self.events[-1][stage] += time.perf_counter() - start
+            return result
+        return wrapper
+
+    def instrument(self, experiment, connectors: list):
+        """
+        Wrap the methods of the experiment and its connectors so the time spent in each stage is recorded.
+        """
+        deliver_stimulus = experiment.deliver_stimulus
+
+        def deliver_and_start_event(event_type):
+            self.new_event()
+            return deliver_stimulus(event_type)
+
+        experiment.deliver_stimulus = deliver_and_start_event
+        experiment.raise_and_lower_trigger = self.timed("trigger", experiment.raise_and_lower_trigger)
+        experiment.update_QUEST = self.timed("staircase", experiment.update_QUEST)
+        experiment.QUEST_reset = self.timed("staircase", experiment.QUEST_reset)
+        experiment.log_event = self.timed("logging", experiment.log_event)
+
+        for connector in connectors:
+            connector.send_command = self.timed("serial", connector.send_command)
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame(self.events, columns=STAGES)
+
+
+def scripted_responses(experiment, n_targets: int, ISI: float, latency: float = 0.4, seed: int = 0) -> list:
+    """
+    Responses for stress runs: a random response key for each target, given after latency * ISI seconds.
+    """
+    rng = np.random.default_rng(seed)
+    keys = [key for target_keys in experiment.keys_target.values() for key in target_keys]
+
+    return [(latency * ISI, str(rng.choice(keys))) for _ in range(n_targets)]
+
+
+def stress_run(make_experiment: Callable, ISI: float, n_sequences: int, seed: int = 0) -> tuple[pd.Series, pd.DataFrame]:
+    """
+    Run one block with the given ISI and number of sequences in real time.
+
+    Parameters
+    ----------
+    make_experiment : callable
+        Returns a new (experiment, connectors) tuple, where connectors is a list of the SGC connectors used by the experiment.
+
+    Returns
+    -------
+    errors : pd.Series
+        The onset error of each event.
+    stages : pd.DataFrame
+        The time spent in each stage for each event.
+    """
+    experiment, connectors = make_experiment()
+
+    timer = StageTimer()
+    timer.instrument(experiment, connectors)
+
+    events = experiment.event_sequence(n_sequences, ISI, block_idx=0)
+    experiment.listener = ScriptedListener(scripted_responses(experiment, n_sequences, ISI, seed=seed), clock=experiment.clock)
+
+    log_file = io.StringIO()
+    experiment.write_log_header(log_file)
+    experiment.start_time = experiment.clock()
+    with experiment.dispatching():
+        experiment.loop_over_events(events, log_file)
+
+    log_file.seek(0)
+    return onset_errors(read_session_log(log_file)).reset_index(drop=True), timer.to_frame()
+
+
+def stress_sweep(make_experiment: Callable, ISIs: list, n_sequences: list, tolerance: float = 0.005, seed: int = 0) -> pd.DataFrame:
+    """
+    Sweep the ISI downwards for each number of sequences, stopping at the first ISI where the maximum onset
+    error exceeds the tolerance.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per run with the mean and maximum onset error, whether it was within the tolerance,
+        and the maximum time per event spent in each stage.
+    """
+    results = []
+    for n in sorted(n_sequences):
+        for ISI in sorted(ISIs, reverse=True):
+            errors, stages = stress_run(make_experiment, ISI, n, seed=seed)
+            max_error = errors.abs().max()
+
+            results.append({
+                "n_sequences": n,
+                "ISI": ISI,
+                "mean_onset_error": errors.abs().mean(),
+                "max_onset_error": max_error,
+                "within_tolerance": max_error <= tolerance,
+                **{f"max_{stage}": stages[stage].max() for stage in STAGES},
+            })
+            print(f"n_sequences: {n}, ISI: {ISI}, max onset error: {round(max_error * 1000, 3)} ms")
+
+            if max_error > tolerance:
+                break
+
+    return pd.DataFrame(results)
+
+
+def throughput_ceiling(results: pd.DataFrame) -> pd.DataFrame:
+    """
+    Smallest ISI within the tolerance for each number of sequences, and the stage taking the most time per event at that ISI.
+    """
+    ceiling = []
+    for n, runs in results.groupby("n_sequences"):
+        passed = runs[runs["within_tolerance"]]
+        if passed.empty:
+            ceiling.append({"n_sequences": n, "min_ISI": np.nan, "bottleneck": None})
+            continue
+
+        run = passed.loc[passed["ISI"].idxmin()]
+        stage_times = run[[f"max_{stage}" for stage in STAGES]].astype(float)
+        ceiling.append({
+            "n_sequences": n,
+            "min_ISI": run["ISI"],
+            "max_onset_error": run["max_onset_error"],
+            "bottleneck": stage_times.idxmax().removeprefix("max_"),
+            "bottleneck_time": stage_times.max(),
+        })
+
+    return pd.DataFrame(ceiling)